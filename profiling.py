@@ -0,0 +1,251 @@
+from contextlib import contextmanager, nullcontext
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+
+# Per-request span trace. Spans are stored as raw perf_counter values and
+# converted to milliseconds relative to the start of the request on export.
+class RequestTrace:
+    sampled = True
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = datetime.now().isoformat()
+        self.start = time.perf_counter()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.perf_counter())
+
+    def add_span(self, name: str, start: float, end: float):
+        self.spans.append((name, start, end))
+
+    def get_span(self, name: str):
+        for span in self.spans:
+            if span[0] == name:
+                return span
+        return None
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round((start - self.start) * 1000, 3),
+                    "duration_ms": round((end - start) * 1000, 3)
+                }
+                for name, start, end in self.spans
+            ]
+        }
+
+# Stand-in used when a request isn't sampled, so instrumented code costs
+# no more than entering an empty context manager
+class NullTrace:
+    sampled = False
+    trace_id = None
+    _span = nullcontext()
+
+    def span(self, name: str):
+        return self._span
+
+    def add_span(self, name: str, start: float, end: float):
+        pass
+
+NULL_TRACE = NullTrace()
+
+# Sampling decision and trace storage (one JSON object per line in trace_file).
+# Traces are handed to a background writer thread so request handling never
+# waits on disk; once trace_file reaches max_bytes it is rotated to
+# trace_file + ".1", replacing any previous rotation.
+class Tracer:
+    def __init__(self, sample_rate: float, trace_file: str, max_bytes: int = 10 * 1024 * 1024,
+                 max_queued: int = 1000):
+        self.sample_rate = sample_rate
+        self.trace_file = trace_file
+        self.max_bytes = max_bytes
+        self.traces_written = 0
+        self.traces_dropped = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._writer = None
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+
+    def should_sample(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def record(self, trace: RequestTrace):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="trace-writer",
+                                                daemon=True)
+                self._writer.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.traces_dropped += 1
+
+    # Block until every queued trace has been written
+    def flush(self):
+        self._queue.join()
+
+    def _write_loop(self):
+        while True:
+            trace = self._queue.get()
+            try:
+                self._write(json.dumps(trace.to_dict()))
+            except OSError as e:
+                print(f"Error writing trace: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, line: str):
+        with self._file_lock:
+            try:
+                if os.path.getsize(self.trace_file) >= self.max_bytes:
+                    os.replace(self.trace_file, self.trace_file + ".1")
+            except FileNotFoundError:
+                pass
+            with open(self.trace_file, "a") as f:
+                f.write(line + "\n")
+            self.traces_written += 1
+
+    # Consistent snapshot of trace_file (None if nothing has been written).
+    # Held against the writer so a download never sees a partial append or
+    # a rotation.
+    def read_traces(self):
+        with self._file_lock:
+            try:
+                with open(self.trace_file, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+# ASGI middleware that samples requests, exposes the trace to handlers as
+# request.state.trace and returns its id in the X-Trace-Id header.
+# Unsampled requests are passed straight through.
+class TraceMiddleware:
+    def __init__(self, app, tracer: Tracer, exclude_prefix: Optional[str] = None):
+        self.app = app
+        self.tracer = tracer
+        self.exclude_prefix = exclude_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.should_sample():
+            await self.app(scope, receive, send)
+            return
+        if self.exclude_prefix and scope["path"].startswith(self.exclude_prefix):
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(f"{scope['method']} {scope['path']}")
+        scope.setdefault("state", {})["trace"] = trace
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                now = time.perf_counter()
+                # Time outside the handler: body parsing/validation before it,
+                # response encoding after it
+                handler = trace.get_span("handler")
+                if handler is not None:
+                    trace.add_span("parse_validate", trace.start, handler[1])
+                    trace.add_span("serialize", handler[2], now)
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-trace-id", trace.trace_id.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            trace.add_span("total", trace.start, time.perf_counter())
+            self.tracer.record(trace)
+
+# Statistical profiler: a background thread samples every thread's stack at a
+# fixed interval and aggregates them in collapsed ("folded") format, which
+# flamegraph.pl, speedscope and similar tools read directly.
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.started_at = None
+        self.stopped_at = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float):
+        with self._lock:
+            if self.running:
+                raise RuntimeError("Profiler is already running")
+            self.samples = Counter()
+            self.started_at = datetime.now().isoformat()
+            self.stopped_at = None
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(time.monotonic() + seconds,),
+                name="sampling-profiler", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self, deadline: float):
+        own_ident = threading.get_ident()
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)))
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self.samples.update(stacks)
+            self._stop.wait(self.interval)
+        self.stopped_at = datetime.now().isoformat()
+
+    def status(self):
+        with self._lock:
+            sample_count = sum(self.samples.values())
+        return {
+            "running": self.running,
+            "interval_seconds": self.interval,
+            "started_at": self.started_at,
+            "stopped_at": self.stopped_at,
+            "samples": sample_count
+        }
+
+    def collapsed(self):
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.samples.items())
@@ -1,12 +1,19 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
+from contextlib import asynccontextmanager
 import google.generativeai as genai
 from datetime import datetime
+import asyncio
+import secrets
+import time
+import uuid
 import re
 import os
 from dotenv import load_dotenv
+from profiling import NULL_TRACE, SamplingProfiler, TraceMiddleware, Tracer
 
 # Load environment variables from .env file (if present)
 load_dotenv()
@@ -19,7 +26,45 @@ if not gemini_api_key:
 else:
     genai.configure(api_key=gemini_api_key)
 
-app = FastAPI()
+# Background jobs need a long-running process (see the job section below),
+# so they are off by default on Vercel, which sets VERCEL in its environment
+JOBS_ENABLED = os.environ.get(
+    "JOBS_ENABLED", "false" if os.environ.get("VERCEL") else "true"
+).lower() in ("1", "true", "yes")
+
+# Async job settings: concurrent generations, cap on queued/running jobs,
+# how long finished results are kept, the longest allowed long-poll and
+# the deadline for a single job
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", "4"))
+JOB_MAX_PENDING = int(os.environ.get("JOB_MAX_PENDING", "100"))
+JOB_RESULT_TTL_SECONDS = int(os.environ.get("JOB_RESULT_TTL_SECONDS", "600"))
+JOB_MAX_WAIT_SECONDS = float(os.environ.get("JOB_MAX_WAIT_SECONDS", "25"))
+JOB_TIMEOUT_SECONDS = float(os.environ.get("JOB_TIMEOUT_SECONDS", "120"))
+
+# Profiling settings: admin key for /api/admin endpoints (disabled when unset),
+# fraction of requests to trace, where traces are written (rotated to
+# TRACE_FILE.1 at TRACE_FILE_MAX_BYTES), and profiler limits
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.environ.get("TRACE_FILE", "/tmp/silicon-bot-traces.jsonl")
+TRACE_FILE_MAX_BYTES = int(os.environ.get("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+PROFILER_INTERVAL_SECONDS = float(os.environ.get("PROFILER_INTERVAL_SECONDS", "0.005"))
+PROFILER_MAX_SECONDS = float(os.environ.get("PROFILER_MAX_SECONDS", "300"))
+
+# Start the Gemini call before the local guardrail checks finish (see
+# generate_support_response_speculative)
+SPECULATIVE_PIPELINE = os.environ.get("SPECULATIVE_PIPELINE", "false").lower() in ("1", "true", "yes")
+
+tracer = Tracer(sample_rate=TRACE_SAMPLE_RATE, trace_file=TRACE_FILE, max_bytes=TRACE_FILE_MAX_BYTES)
+profiler = SamplingProfiler(interval=PROFILER_INTERVAL_SECONDS)
+
+# Stop background work (jobs, profiler) when the server shuts down
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await stop_background_work()
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS for web integration
 app.add_middleware(
@@ -28,8 +73,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
 
+# Sampled per-request span tracing (see profiling.py)
+app.add_middleware(TraceMiddleware, tracer=tracer, exclude_prefix="/api/admin")
+
 # Contact information
 CONTACT_INFO = """
 For further assistance, please contact us at:
@@ -106,45 +155,43 @@ def needs_contact_info(response_text):
             return True
     return False
 
-# Simple endpoint for customer support
-@app.post("/api/support")
-async def handle_support_query(conversation: Conversation, agent_config: AgentConfig):
-    try:
-        # Check if API key is configured
-        if not gemini_api_key:
-            raise HTTPException(status_code=500, 
-                                detail="GEMINI_API_KEY environment variable not set")
-        
-        # Get the user's question
-        if not conversation.messages or len(conversation.messages) == 0:
-            raise HTTPException(status_code=400, detail="No messages provided")
-        
-        user_message = conversation.messages[0].content
-        
-        # Check if the question is inappropriate
-        if is_inappropriate(user_message):
-            response_text = "I'm sorry, but I cannot assist with inappropriate or illegal topics. " + CONTACT_INFO
-            return {
-                "response": {
-                    "role": "agent",
-                    "content": response_text,
-                    "timestamp": datetime.now().isoformat()
-                }
-            }
-        
-        # Check for special requests that don't need AI processing
+# Wrap reply text in the response format returned by the support endpoints
+def agent_response(content):
+    return {
+        "response": {
+            "role": "agent",
+            "content": content,
+            "timestamp": datetime.now().isoformat()
+        }
+    }
+
+# Get the user's question from the conversation
+def get_user_message(conversation: Conversation):
+    if not conversation.messages or len(conversation.messages) == 0:
+        raise HTTPException(status_code=400, detail="No messages provided")
+    
+    return conversation.messages[0].content
+
+# Local checks that can answer without calling Gemini. Returns the reply
+# text when one of them short-circuits the request, otherwise None.
+def run_local_checks(user_message, trace=NULL_TRACE):
+    # Check if the question is inappropriate
+    with trace.span("guardrails"):
+        inappropriate = is_inappropriate(user_message)
+    if inappropriate:
+        return "I'm sorry, but I cannot assist with inappropriate or illegal topics. " + CONTACT_INFO
+    
+    # Check for special requests that don't need AI processing
+    with trace.span("special_requests"):
         special_response = handle_special_requests(user_message)
-        if special_response:
-            return {
-                "response": {
-                    "role": "agent",
-                    "content": special_response,
-                    "timestamp": datetime.now().isoformat()
-                }
-            }
-            
-        # Prepare prompt for Gemini with specific instructions
-        prompt = f"""As a customer support agent named {agent_config.name}, your role is to:
+    if special_response:
+        return special_response
+    
+    return None
+
+# Prepare prompt for Gemini with specific instructions
+def build_support_prompt(agent_config: AgentConfig, user_message):
+    return f"""As a customer support agent named {agent_config.name}, your role is to:
 {agent_config.instructions}
 
 IMPORTANT INSTRUCTIONS:
@@ -158,30 +205,25 @@ IMPORTANT INSTRUCTIONS:
 User's question: "{user_message}"
 
 Provide a focused, specific answer to this exact question:"""
-        
-        # Call Gemini API
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(prompt)
-        
-        # Format response
-        response_text = response.text
-        
-        # Verify the response isn't too generic
-        generic_patterns = [
-            r"^Thank you for your message\W+How (else )?can I help you",
-            r"^Thanks for reaching out\W+How (else )?can I assist you",
-            r"^How (else )?can I help you today\W*$"
-        ]
-        
-        is_generic = False
-        for pattern in generic_patterns:
-            if re.search(pattern, response_text, re.IGNORECASE):
-                is_generic = True
-                break
-                
-        # If response is too generic, provide more specific help
-        if is_generic:
-            response_text = f"""I'd be happy to help you more specifically. 
+
+# Replace generic replies and add contact info when Gemini seems unsure
+def finalize_response_text(response_text):
+    # Verify the response isn't too generic
+    generic_patterns = [
+        r"^Thank you for your message\W+How (else )?can I help you",
+        r"^Thanks for reaching out\W+How (else )?can I assist you",
+        r"^How (else )?can I help you today\W*$"
+    ]
+    
+    is_generic = False
+    for pattern in generic_patterns:
+        if re.search(pattern, response_text, re.IGNORECASE):
+            is_generic = True
+            break
+            
+    # If response is too generic, provide more specific help
+    if is_generic:
+        response_text = f"""I'd be happy to help you more specifically. 
 
 For questions about our products and services, I can provide details on features, pricing, and compatibility.
 
@@ -192,25 +234,342 @@ For account or billing questions, I can explain our policies and options.
 {CONTACT_INFO}
 
 Please let me know what specific information you're looking for, and I'll assist you right away."""
-        
-        # Add contact info if the response seems unsure
-        if needs_contact_info(response_text):
-            if not response_text.endswith(CONTACT_INFO):
-                response_text += CONTACT_INFO
-        
-        # Return formatted response
-        return {
-            "response": {
-                "role": "agent",
-                "content": response_text,
-                "timestamp": datetime.now().isoformat()
-            }
-        }
+    
+    # Add contact info if the response seems unsure
+    if needs_contact_info(response_text):
+        if not response_text.endswith(CONTACT_INFO):
+            response_text += CONTACT_INFO
+    
+    return response_text
+
+# Call Gemini without blocking the event loop; cancelling the awaiting task
+# aborts the in-flight request
+async def call_gemini_async(prompt):
+    model = genai.GenerativeModel('gemini-1.5-flash')
+    response = await model.generate_content_async(prompt)
+    return response.text
+
+# Steps shared by the normal and speculative pipelines: check the API key,
+# find the user's question and build the Gemini prompt
+def prepare_support_request(conversation: Conversation, agent_config: AgentConfig, trace=NULL_TRACE):
+    # Check if API key is configured
+    if not gemini_api_key:
+        raise HTTPException(status_code=500, 
+                            detail="GEMINI_API_KEY environment variable not set")
+    
+    with trace.span("find_user_message"):
+        user_message = get_user_message(conversation)
+    
+    with trace.span("format_prompt"):
+        prompt = build_support_prompt(agent_config, user_message)
+    
+    return user_message, prompt
+
+# Turn Gemini's text into the final agent response
+def complete_support_response(response_text, trace=NULL_TRACE):
+    with trace.span("postprocess"):
+        response_text = finalize_response_text(response_text)
+    
+    return agent_response(response_text)
+
+# Generate the agent's reply for a conversation (shared by the sync and job
+# endpoints). The Gemini call is awaited, so it holds no thread while in
+# flight and a job that hits its deadline cancels it.
+async def generate_support_response(conversation: Conversation, agent_config: AgentConfig, trace=NULL_TRACE):
+    user_message, prompt = prepare_support_request(conversation, agent_config, trace)
+    
+    short_circuit = run_local_checks(user_message, trace)
+    if short_circuit is not None:
+        return agent_response(short_circuit)
+    
+    with trace.span("gemini_call"):
+        response_text = await call_gemini_async(prompt)
+    
+    return complete_support_response(response_text, trace)
+
+# Counters for the speculative pipeline. Only touched from the event loop.
+speculation_stats = {
+    "speculative_calls": 0,
+    "used": 0,
+    "wasted": 0,
+    "errors": 0,
+    "latency_saved_seconds": 0.0,
+    "wasted_upstream_seconds": 0.0
+}
+
+# Run the local checks and time them inside the worker thread, so the
+# thread-pool handoff isn't counted as time saved
+def timed_local_checks(user_message, trace=NULL_TRACE):
+    start = time.perf_counter()
+    short_circuit = run_local_checks(user_message, trace)
+    return short_circuit, time.perf_counter() - start
+
+# Speculative variant of generate_support_response: the Gemini call starts
+# before the local checks run (in a worker thread, so both make progress).
+# If a check short-circuits the request, the in-flight call is cancelled and
+# its result is never used. Time saved on a used call is the overlap of the
+# two, i.e. the shorter of the local checks and the upstream call.
+async def generate_support_response_speculative(conversation: Conversation, agent_config: AgentConfig, trace=NULL_TRACE):
+    user_message, prompt = prepare_support_request(conversation, agent_config, trace)
+    
+    async def call_gemini():
+        response_text = await call_gemini_async(prompt)
+        return response_text, time.perf_counter()
+    
+    upstream_start = time.perf_counter()
+    upstream = asyncio.create_task(call_gemini())
+    speculation_stats["speculative_calls"] += 1
+    
+    try:
+        short_circuit, checks_seconds = await asyncio.to_thread(timed_local_checks, user_message, trace)
+    except BaseException:
+        upstream.cancel()
+        speculation_stats["errors"] += 1
+        raise
+    
+    if short_circuit is not None:
+        upstream.cancel()
+        await asyncio.gather(upstream, return_exceptions=True)
+        speculation_stats["wasted"] += 1
+        speculation_stats["wasted_upstream_seconds"] += time.perf_counter() - upstream_start
+        return agent_response(short_circuit)
+    
+    try:
+        response_text, upstream_end = await upstream
+    except BaseException:
+        speculation_stats["errors"] += 1
+        raise
+    trace.add_span("gemini_call", upstream_start, upstream_end)
+    speculation_stats["used"] += 1
+    speculation_stats["latency_saved_seconds"] += min(checks_seconds, upstream_end - upstream_start)
+    
+    return complete_support_response(response_text, trace)
+
+# Simple endpoint for customer support
+@app.post("/api/support")
+async def handle_support_query(conversation: Conversation, agent_config: AgentConfig, request: Request):
+    trace = getattr(request.state, "trace", NULL_TRACE)
+    try:
+        with trace.span("handler"):
+            if SPECULATIVE_PIPELINE:
+                return await generate_support_response_speculative(conversation, agent_config, trace)
+            return await generate_support_response(conversation, agent_config, trace)
     
     except Exception as e:
         print(f"Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Background jobs for long-running support queries. Jobs run as tasks on the
+# server's event loop, at most JOB_MAX_WORKERS generations at a time, and each
+# is cancelled after JOB_TIMEOUT_SECONDS. Job state lives in this process's
+# memory, so these endpoints need a long-running server (e.g. `python
+# simple_bot.py` under uvicorn with a single worker); on serverless platforms
+# such as Vercel the instance may be frozen after the 202 is returned and
+# polls may reach a different instance.
+jobs: Dict[str, Dict[str, Any]] = {}
+# Binds to the running event loop on first use
+job_slots = asyncio.Semaphore(JOB_MAX_WORKERS)
+
+# Refuse job requests where jobs would be lost instead of returning 202
+def require_jobs_enabled():
+    if not JOBS_ENABLED:
+        raise HTTPException(status_code=501,
+                            detail="Background jobs are disabled on this deployment; use /api/support")
+
+# Drop finished jobs whose results have expired
+def purge_expired_jobs():
+    now = time.time()
+    expired = [job_id for job_id, job in jobs.items()
+               if job["expires_at"] is not None and job["expires_at"] <= now]
+    for job_id in expired:
+        del jobs[job_id]
+
+# Public view of a job (everything except the internal task)
+def job_status(job):
+    status = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"]
+    }
+    if job["status"] == "completed":
+        status["response"] = job["result"]["response"]
+    elif job["status"] == "failed":
+        status["error"] = job["error"]
+    return status
+
+# Record a job's outcome and start its result TTL
+def finish_job(job, result=None, error=None):
+    job["status"] = "completed" if error is None else "failed"
+    job["result"] = result
+    job["error"] = error
+    job["finished_at"] = datetime.now().isoformat()
+    job["expires_at"] = time.time() + JOB_RESULT_TTL_SECONDS
+
+# Worker: wait for a free slot, generate the response and record the outcome
+async def run_support_job(job, conversation: Conversation, agent_config: AgentConfig):
+    try:
+        async with job_slots:
+            job["status"] = "running"
+            result = await asyncio.wait_for(
+                generate_support_response(conversation, agent_config),
+                timeout=JOB_TIMEOUT_SECONDS
+            )
+        finish_job(job, result=result)
+    except asyncio.TimeoutError:
+        finish_job(job, error={"status_code": 504, "detail": "Job timed out"})
+    except asyncio.CancelledError:
+        finish_job(job, error={"status_code": 503, "detail": "Job cancelled by server shutdown"})
+        raise
+    except HTTPException as e:
+        finish_job(job, error={"status_code": e.status_code, "detail": e.detail})
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        finish_job(job, error={"status_code": 500, "detail": str(e)})
+
+# Submit a support query as a background job and return its id immediately
+@app.post("/api/support/jobs", status_code=202, dependencies=[Depends(require_jobs_enabled)])
+async def create_support_job(conversation: Conversation, agent_config: AgentConfig):
+    purge_expired_jobs()
+    pending = sum(1 for job in jobs.values() if job["status"] in ("queued", "running"))
+    if pending >= JOB_MAX_PENDING:
+        raise HTTPException(status_code=503, detail="Too many pending jobs, please retry later")
+
+    job_id = uuid.uuid4().hex
+    job = {
+        "id": job_id,
+        "status": "queued",
+        "created_at": datetime.now().isoformat(),
+        "finished_at": None,
+        "expires_at": None,
+        "result": None,
+        "error": None,
+        "task": None
+    }
+    jobs[job_id] = job
+    job["task"] = asyncio.create_task(run_support_job(job, conversation, agent_config))
+
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "poll_url": f"/api/support/jobs/{job_id}"
+    }
+
+# Poll a job; pass ?wait=N to long-poll for up to N seconds until it finishes
+@app.get("/api/support/jobs/{job_id}", dependencies=[Depends(require_jobs_enabled)])
+async def get_support_job(job_id: str, wait: float = 0):
+    purge_expired_jobs()
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+
+    wait = min(max(wait, 0), JOB_MAX_WAIT_SECONDS)
+    if wait > 0 and not job["task"].done():
+        # Shield so a timed-out poll doesn't cancel the job itself
+        await asyncio.wait([asyncio.shield(job["task"])], timeout=wait)
+
+    return job_status(job)
+
+# Require a valid X-Admin-Key header; admin endpoints are off unless ADMIN_API_KEY is set
+def require_admin(x_admin_key: Optional[str] = Header(None)):
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=403, detail="Admin API is disabled (ADMIN_API_KEY not set)")
+    if not x_admin_key or not secrets.compare_digest(x_admin_key.encode(), ADMIN_API_KEY.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin key")
+
+class TracingSettings(BaseModel):
+    sample_rate: float = Field(ge=0, le=1)
+
+# Current tracing and profiler state
+@app.get("/api/admin/profiling", dependencies=[Depends(require_admin)])
+async def get_profiling_status():
+    return {
+        "tracing": {
+            "sample_rate": tracer.sample_rate,
+            "trace_file": tracer.trace_file,
+            "traces_written": tracer.traces_written,
+            "traces_dropped": tracer.traces_dropped
+        },
+        "profiler": profiler.status()
+    }
+
+# Change the fraction of requests that get span traces (0 disables tracing)
+@app.put("/api/admin/profiling/tracing", dependencies=[Depends(require_admin)])
+async def update_tracing(settings: TracingSettings):
+    tracer.sample_rate = settings.sample_rate
+    return {"sample_rate": tracer.sample_rate}
+
+# Download the recorded span traces (JSON lines)
+@app.get("/api/admin/profiling/traces", dependencies=[Depends(require_admin)])
+async def download_traces():
+    # Serve a snapshot rather than the live file, which the writer thread
+    # may append to or rotate mid-download
+    traces = await asyncio.to_thread(tracer.read_traces)
+    if traces is None:
+        raise HTTPException(status_code=404, detail="No traces recorded yet")
+    return Response(
+        traces,
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="traces.jsonl"'}
+    )
+
+# Start the statistical profiler on this worker for the given number of seconds
+@app.post("/api/admin/profiling/profiler/start", dependencies=[Depends(require_admin)])
+async def start_profiler(seconds: float = 30):
+    if not (0 < seconds <= PROFILER_MAX_SECONDS):
+        raise HTTPException(status_code=400,
+                            detail=f"seconds must be between 0 and {PROFILER_MAX_SECONDS}")
+    try:
+        profiler.start(seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return profiler.status()
+
+# Stop the profiler early
+@app.post("/api/admin/profiling/profiler/stop", dependencies=[Depends(require_admin)])
+async def stop_profiler():
+    await asyncio.to_thread(profiler.stop)
+    return profiler.status()
+
+# Download the collected samples in collapsed stack format (flamegraph.pl, speedscope)
+@app.get("/api/admin/profiling/profiler/output", dependencies=[Depends(require_admin)])
+async def download_profile():
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="Profiler is still running")
+    return PlainTextResponse(
+        profiler.collapsed(),
+        headers={"Content-Disposition": 'attachment; filename="profile.folded"'}
+    )
+
+# Speculative pipeline stats: how often the early Gemini call was used,
+# wasted or failed, and how much latency it saved
+@app.get("/api/admin/speculation", dependencies=[Depends(require_admin)])
+async def get_speculation_stats():
+    calls = speculation_stats["speculative_calls"]
+    used = speculation_stats["used"]
+    wasted = speculation_stats["wasted"]
+    errors = speculation_stats["errors"]
+    return {
+        "enabled": SPECULATIVE_PIPELINE,
+        "speculative_calls": calls,
+        "used": used,
+        "wasted": wasted,
+        "errors": errors,
+        "waste_rate": wasted / (used + wasted) if used + wasted else 0.0,
+        "latency_saved_ms": round(speculation_stats["latency_saved_seconds"] * 1000, 3),
+        "avg_latency_saved_ms": round(speculation_stats["latency_saved_seconds"] * 1000 / used, 3) if used else 0.0,
+        "wasted_upstream_ms": round(speculation_stats["wasted_upstream_seconds"] * 1000, 3)
+    }
+
+# Cancel running jobs and stop the profiler (called from lifespan)
+async def stop_background_work():
+    # Cancelled jobs are marked failed by run_support_job
+    tasks = [job["task"] for job in jobs.values() if not job["task"].done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    profiler.stop()
+
 # Health check endpoint
 @app.get("/api/health")
 async def health_check():
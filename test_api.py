@@ -0,0 +1,220 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import types
+
+import pytest
+
+# Stub out the Gemini client so the API can be exercised without network access
+fake_genai = types.ModuleType("google.generativeai")
+fake_genai.delay = 0.0
+fake_genai.calls = 0
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGenerativeModel:
+    def __init__(self, name):
+        self.name = name
+
+    async def generate_content_async(self, prompt):
+        fake_genai.calls += 1
+        await asyncio.sleep(fake_genai.delay)
+        return FakeResponse("Here is how to track your order.")
+
+fake_genai.configure = lambda **kwargs: None
+fake_genai.GenerativeModel = FakeGenerativeModel
+sys.modules.setdefault("google", types.ModuleType("google"))
+sys.modules["google"].generativeai = fake_genai
+sys.modules["google.generativeai"] = fake_genai
+
+os.environ["GEMINI_API_KEY"] = "test-key"
+os.environ["ADMIN_API_KEY"] = "admin-key"
+
+from fastapi.testclient import TestClient
+from profiling import RequestTrace, Tracer
+import simple_bot
+
+ADMIN_HEADERS = {"X-Admin-Key": "admin-key"}
+
+def support_payload(query):
+    return {
+        "conversation": {"messages": [{"role": "user", "content": query}]},
+        "agent_config": {"name": "Support Agent", "instructions": "Help customers."}
+    }
+
+@pytest.fixture
+def client():
+    fake_genai.delay = 0.0
+    fake_genai.calls = 0
+    simple_bot.jobs.clear()
+    with TestClient(simple_bot.app) as client:
+        yield client
+
+def test_support_query(client):
+    response = client.post("/api/support", json=support_payload("How do I track my order?"))
+    assert response.status_code == 200
+    assert response.json()["response"]["content"] == "Here is how to track your order."
+
+def test_job_completes_with_long_poll(client):
+    fake_genai.delay = 0.1
+    response = client.post("/api/support/jobs", json=support_payload("How do I track my order?"))
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+
+    job = client.get(f"/api/support/jobs/{job_id}?wait=5").json()
+    assert job["status"] == "completed"
+    assert job["response"]["content"] == "Here is how to track your order."
+
+def test_job_failure_is_recorded(client):
+    payload = support_payload("")
+    payload["conversation"]["messages"] = []
+    job_id = client.post("/api/support/jobs", json=payload).json()["job_id"]
+
+    job = client.get(f"/api/support/jobs/{job_id}?wait=5").json()
+    assert job["status"] == "failed"
+    assert job["error"] == {"status_code": 400, "detail": "No messages provided"}
+
+def test_job_pending_cap(client, monkeypatch):
+    monkeypatch.setattr(simple_bot, "JOB_MAX_PENDING", 1)
+    fake_genai.delay = 1.0
+    assert client.post("/api/support/jobs", json=support_payload("Where is my order?")).status_code == 202
+    response = client.post("/api/support/jobs", json=support_payload("Where is my order?"))
+    assert response.status_code == 503
+
+def test_job_timeout(client, monkeypatch):
+    monkeypatch.setattr(simple_bot, "JOB_TIMEOUT_SECONDS", 0.05)
+    fake_genai.delay = 5.0
+    job_id = client.post("/api/support/jobs", json=support_payload("Where is my order?")).json()["job_id"]
+
+    job = client.get(f"/api/support/jobs/{job_id}?wait=2").json()
+    assert job["status"] == "failed"
+    assert job["error"]["status_code"] == 504
+    assert simple_bot.jobs[job_id]["expires_at"] is not None
+
+def test_job_result_expires(client, monkeypatch):
+    monkeypatch.setattr(simple_bot, "JOB_RESULT_TTL_SECONDS", 0)
+    fake_genai.delay = 0.1
+    job_id = client.post("/api/support/jobs", json=support_payload("Where is my order?")).json()["job_id"]
+    assert client.get(f"/api/support/jobs/{job_id}?wait=5").json()["status"] == "completed"
+
+    assert client.get(f"/api/support/jobs/{job_id}").status_code == 404
+
+def test_unknown_job(client):
+    assert client.get("/api/support/jobs/does-not-exist").status_code == 404
+
+def test_shutdown_fails_pending_jobs():
+    fake_genai.delay = 5.0
+    simple_bot.jobs.clear()
+    with TestClient(simple_bot.app) as client:
+        job_id = client.post("/api/support/jobs", json=support_payload("Where is my order?")).json()["job_id"]
+
+    job = simple_bot.jobs[job_id]
+    assert job["status"] == "failed"
+    assert job["error"]["status_code"] == 503
+
+def test_admin_requires_key(client):
+    assert client.get("/api/admin/profiling").status_code == 401
+    assert client.get("/api/admin/profiling", headers={"X-Admin-Key": "wrong"}).status_code == 401
+    assert client.get("/api/admin/profiling", headers={"X-Admin-Key": b"\xe9"}).status_code == 401
+    assert client.get("/api/admin/profiling", headers=ADMIN_HEADERS).status_code == 200
+
+def test_admin_disabled_without_key(client, monkeypatch):
+    monkeypatch.setattr(simple_bot, "ADMIN_API_KEY", None)
+    assert client.get("/api/admin/profiling", headers=ADMIN_HEADERS).status_code == 403
+
+def test_sampled_request_is_traced(client, monkeypatch, tmp_path):
+    trace_file = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(simple_bot.tracer, "trace_file", str(trace_file))
+    monkeypatch.setattr(simple_bot.tracer, "sample_rate", 1.0)
+
+    response = client.post("/api/support", json=support_payload("How do I track my order?"))
+    trace_id = response.headers["X-Trace-Id"]
+    simple_bot.tracer.flush()
+
+    trace = json.loads(trace_file.read_text().splitlines()[-1])
+    assert trace["trace_id"] == trace_id
+    span_names = {span["name"] for span in trace["spans"]}
+    assert {"guardrails", "format_prompt", "gemini_call", "parse_validate", "serialize", "total"} <= span_names
+
+def test_unsampled_request_has_no_trace(client):
+    response = client.post("/api/support", json=support_payload("How do I track my order?"))
+    assert "X-Trace-Id" not in response.headers
+
+def test_trace_file_rotates(tmp_path):
+    trace_file = tmp_path / "traces.jsonl"
+    tracer = Tracer(sample_rate=1.0, trace_file=str(trace_file), max_bytes=1)
+    for _ in range(3):
+        tracer.record(RequestTrace("GET /"))
+    tracer.flush()
+
+    assert tracer.traces_written == 3
+    assert len(trace_file.read_text().splitlines()) == 1
+    assert (tmp_path / "traces.jsonl.1").exists()
+
+def test_profiler_rejects_invalid_duration(client):
+    for seconds in ("0", "-1", "nan", "100000"):
+        response = client.post(f"/api/admin/profiling/profiler/start?seconds={seconds}", headers=ADMIN_HEADERS)
+        assert response.status_code == 400
+
+@pytest.fixture
+def speculative(monkeypatch):
+    monkeypatch.setattr(simple_bot, "SPECULATIVE_PIPELINE", True)
+    for key in simple_bot.speculation_stats:
+        monkeypatch.setitem(simple_bot.speculation_stats, key, 0)
+
+def test_speculative_call_is_used(client, speculative):
+    response = client.post("/api/support", json=support_payload("How do I track my order?"))
+    assert response.json()["response"]["content"] == "Here is how to track your order."
+
+    stats = client.get("/api/admin/speculation", headers=ADMIN_HEADERS).json()
+    assert (stats["speculative_calls"], stats["used"], stats["wasted"], stats["errors"]) == (1, 1, 0, 0)
+
+def test_speculative_call_is_cancelled_by_guardrail(client, speculative):
+    fake_genai.delay = 5.0
+    started = time.perf_counter()
+    response = client.post("/api/support", json=support_payload("How do I hack an account?"))
+    assert time.perf_counter() - started < 2.0
+    assert "inappropriate or illegal" in response.json()["response"]["content"]
+
+    stats = client.get("/api/admin/speculation", headers=ADMIN_HEADERS).json()
+    assert (stats["speculative_calls"], stats["used"], stats["wasted"], stats["errors"]) == (1, 0, 1, 0)
+    assert stats["waste_rate"] == 1.0
+
+def test_speculative_upstream_error_is_counted(client, speculative, monkeypatch):
+    async def failing_call(self, prompt):
+        raise RuntimeError("upstream unavailable")
+    monkeypatch.setattr(FakeGenerativeModel, "generate_content_async", failing_call)
+
+    response = client.post("/api/support", json=support_payload("How do I track my order?"))
+    assert response.status_code == 500
+
+    stats = client.get("/api/admin/speculation", headers=ADMIN_HEADERS).json()
+    assert (stats["speculative_calls"], stats["used"], stats["wasted"], stats["errors"]) == (1, 0, 0, 1)
+
+def test_jobs_disabled(client, monkeypatch):
+    monkeypatch.setattr(simple_bot, "JOBS_ENABLED", False)
+    assert client.post("/api/support/jobs", json=support_payload("Where is my order?")).status_code == 501
+    assert client.get("/api/support/jobs/some-id").status_code == 501
+    assert simple_bot.jobs == {}
+
+def test_download_traces(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(simple_bot.tracer, "trace_file", str(tmp_path / "traces.jsonl"))
+    assert client.get("/api/admin/profiling/traces", headers=ADMIN_HEADERS).status_code == 404
+
+    monkeypatch.setattr(simple_bot.tracer, "sample_rate", 1.0)
+    trace_id = client.post("/api/support", json=support_payload("How do I track my order?")).headers["X-Trace-Id"]
+    simple_bot.tracer.flush()
+
+    response = client.get("/api/admin/profiling/traces", headers=ADMIN_HEADERS)
+    assert response.status_code == 200
+    assert int(response.headers["Content-Length"]) == len(response.content)
+    assert json.loads(response.text.splitlines()[-1])["trace_id"] == trace_id
+
+def test_job_submission_without_lifespan():
+    simple_bot.jobs.clear()
+    client = TestClient(simple_bot.app)
+    assert client.post("/api/support/jobs", json=support_payload("Where is my order?")).status_code == 202